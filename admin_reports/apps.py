@@ -3,9 +3,17 @@ from django.utils.module_loading import autodiscover_modules
 from .sites import site
 
 
-class AdminReportConfig(AppConfig):
+class SimpleAdminReportConfig(AppConfig):
+    """ Simple AppConfig which does not do automatic discovery of the
+    ``reports`` modules.
+    """
+
     name = "admin_reports"
 
+
+class AdminReportConfig(SimpleAdminReportConfig):
+    default = True
+
     def autodiscover(self):
         autodiscover_modules("reports", register_to=site)
 
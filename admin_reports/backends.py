@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from .totals import make_reducer
+
+# auto_totals functions the backends can compute natively; "len" counts
+# every row, "count" only the values that are not null
+aggregations = {
+    sum: "sum",
+    len: "len",
+    min: "min",
+    max: "max",
+    "sum": "sum",
+    "count": "count",
+    "min": "min",
+    "max": "max",
+    "mean": "mean",
+}
+
+
+def _module_root(obj):
+    return type(obj).__module__.lstrip("_").split(".")[0]
+
+
+def is_dataframe(results):
+    """ Whether ``results`` is a pandas ``DataFrame``; pandas is imported
+    only if ``results`` comes from it, in which case it is loaded already.
+    """
+    if not any(
+        cls.__module__.split(".")[0] == "pandas" for cls in type(results).__mro__
+    ):
+        return False
+    from pandas import DataFrame
+
+    return isinstance(results, DataFrame)
+
+
+class LazyResults(object):
+    """ Base class for results backed by a lazy query engine.
+
+    Sorting only changes the query plan; the plan is executed when a page
+    is sliced, when the records are counted or iterated in batches.
+    Subclasses implement the engine specific operations.
+    """
+
+    batch_size = 10000
+
+    def __init__(self, results):
+        self._results = results
+        self._count = None
+
+    @classmethod
+    def accepts(cls, results):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    @property
+    def columns(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _sorted(self, columns, descending):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _slice(self, offset, length):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _head(self, length):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _batches(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _aggregate(self, aggregates):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def _count_records(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def sort(self, sort_params):
+        columns = []
+        descending = []
+        for param in sort_params:
+            descending.append(param.startswith("-"))
+            columns.append(param[1:] if param.startswith("-") else param)
+        if columns:
+            self._results = self._sorted(columns, descending)
+
+    def split_last(self):
+        """ Remove the last record and return it.
+        """
+        count = self.count()
+        if not count:
+            return {}
+        last = self._slice(count - 1, 1)[0]
+        self._results = self._head(count - 1)
+        self._count = count - 1
+        return last
+
+    def totals(self, auto_totals):
+        native = {}
+        reducers = {}
+        for field_name, func in auto_totals.items():
+            if not func:
+                continue
+            if func in aggregations:
+                native[field_name] = aggregations[func]
+            else:
+                reducers[field_name] = make_reducer(func)
+        totals = self._aggregate(native) if native else {}
+        if reducers:
+            for record in self:
+                for field_name, reducer in reducers.items():
+                    reducer.add(record[field_name])
+            for field_name, reducer in reducers.items():
+                totals[field_name] = reducer.result()
+        return totals
+
+    def count(self):
+        if self._count is None:
+            self._count = self._count_records()
+        return self._count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.count())
+            records = self._slice(start, max(stop - start, 0))
+            return records[::step] if step != 1 else records
+        if key < 0:
+            key += self.count()
+        records = self._slice(key, 1) if key >= 0 else []
+        if not records:
+            raise IndexError("%s index out of range" % self.__class__.__name__)
+        return records[0]
+
+    def __iter__(self):
+        for batch in self._batches():
+            for record in batch:
+                yield record
+
+    def __len__(self):
+        return self.count()
+
+
+class PolarsResults(LazyResults):
+    """ Results from a Polars ``LazyFrame`` (or ``DataFrame``, which is
+    made lazy).
+    """
+
+    def __init__(self, results):
+        if not hasattr(results, "collect"):
+            results = results.lazy()
+        super(PolarsResults, self).__init__(results)
+
+    @classmethod
+    def accepts(cls, results):
+        return _module_root(results) == "polars" and type(results).__name__ in (
+            "LazyFrame",
+            "DataFrame",
+        )
+
+    @property
+    def columns(self):
+        if hasattr(self._results, "collect_schema"):
+            return self._results.collect_schema().names()
+        return self._results.columns
+
+    def _sorted(self, columns, descending):
+        return self._results.sort(columns, descending=descending)
+
+    def _slice(self, offset, length):
+        return self._results.slice(offset, length).collect().to_dicts()
+
+    def _head(self, length):
+        return self._results.head(length)
+
+    def _batches(self):
+        # Never collect the whole frame: stream the plan when the engine
+        # can, otherwise collect one slice at a time
+        if hasattr(self._results, "collect_batches"):
+            for batch in self._results.collect_batches(chunk_size=self.batch_size):
+                yield batch.to_dicts()
+            return
+        offset = 0
+        while True:
+            batch = self._results.slice(offset, self.batch_size).collect()
+            if batch.height:
+                yield batch.to_dicts()
+            if batch.height < self.batch_size:
+                break
+            offset += self.batch_size
+
+    def _aggregate(self, aggregates):
+        import polars
+
+        return (
+            self._results.select(
+                [
+                    polars.len().alias(name)
+                    if aggregate == "len"
+                    else getattr(polars.col(name), aggregate)()
+                    for name, aggregate in aggregates.items()
+                ]
+            )
+            .collect()
+            .to_dicts()[0]
+        )
+
+    def _count_records(self):
+        import polars
+
+        return self._results.select(polars.len()).collect().item()
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+class DuckDBResults(LazyResults):
+    """ Results from a DuckDB relation.
+    """
+
+    @classmethod
+    def accepts(cls, results):
+        return (
+            _module_root(results) == "duckdb"
+            and type(results).__name__ == "DuckDBPyRelation"
+        )
+
+    @property
+    def columns(self):
+        return self._results.columns
+
+    def _to_dicts(self, rows):
+        columns = self.columns
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _sorted(self, columns, descending):
+        return self._results.order(
+            ", ".join(
+                "%s DESC" % _quote(column) if desc else _quote(column)
+                for column, desc in zip(columns, descending)
+            )
+        )
+
+    def _slice(self, offset, length):
+        return self._to_dicts(self._results.limit(length, offset).fetchall())
+
+    def _head(self, length):
+        return self._results.limit(length)
+
+    def _batches(self):
+        # A new relation, so that fetching does not share state with
+        # the queries run for counts and pages
+        relation = self._results.project("*")
+        while True:
+            rows = relation.fetchmany(self.batch_size)
+            if not rows:
+                break
+            yield self._to_dicts(rows)
+
+    def _aggregate(self, aggregates):
+        names = list(aggregates)
+        row = self._results.aggregate(
+            ", ".join(
+                "count(*) AS %s" % _quote(name)
+                if aggregates[name] == "len"
+                else "%s(%s) AS %s" % (aggregates[name], _quote(name), _quote(name))
+                for name in names
+            )
+        ).fetchone()
+        return dict(zip(names, row))
+
+    def _count_records(self):
+        return self._results.aggregate("count(*)").fetchone()[0]
+
+
+backends = [PolarsResults, DuckDBResults]
+
+
+def get_backend(results):
+    """ Return the ``LazyResults`` subclass able to handle ``results``, if
+    any.
+    """
+    for backend in backends:
+        if backend.accepts(results):
+            return backend
+    return None
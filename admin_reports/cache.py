@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Model, QuerySet
+
+
+class ParamsEncoder(DjangoJSONEncoder):
+    """ JSON encoder for report parameters, which can be anything a form
+    field cleans to.
+    """
+
+    def default(self, o):
+        if isinstance(o, Model):
+            return o.pk
+        if isinstance(o, QuerySet):
+            return sorted(o.values_list("pk", flat=True))
+        if isinstance(o, (set, frozenset)):
+            return sorted(o)
+        try:
+            return super(ParamsEncoder, self).default(o)
+        except TypeError:
+            return "%s" % o
+
+
+def make_key(report, name):
+    """ Return the cache key of ``name`` (results, count or totals) for
+    ``report`` with its current parameters.
+    """
+    params = json.dumps(report._params, cls=ParamsEncoder, sort_keys=True)
+    return "admin_reports:%s.%s:%s:%s" % (
+        report.__class__.__module__,
+        report.__class__.__name__,
+        name,
+        hashlib.md5(params.encode("utf-8")).hexdigest(),
+    )
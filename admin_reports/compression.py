@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import zipfile
+import zlib
+
+import six
+from django.conf import settings
+
+
+def _encode(chunk, charset):
+    if isinstance(chunk, six.text_type):
+        return chunk.encode(charset)
+    return chunk
+
+
+def gzip_stream(chunks, charset=None, level=6):
+    """ Compress ``chunks`` to the gzip format while they are produced.
+    """
+    charset = charset or settings.DEFAULT_CHARSET
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(_encode(chunk, charset))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class _StreamBuffer(object):
+    """ Write-only, non seekable file that ``ZipFile`` writes into and the
+    streaming generator empties after every write.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_stream(members, charset=None):
+    """ Build a zip archive while its members are produced.
+
+    ``members`` is a sequence of ``(name, chunks)`` couples; the size of
+    the members is unknown in advance, so they are written as ZIP64 with
+    data descriptors.
+    """
+    charset = charset or settings.DEFAULT_CHARSET
+    buf = _StreamBuffer()
+    with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, chunks in members:
+            with archive.open(name, mode="w", force_zip64=True) as member:
+                for chunk in chunks:
+                    member.write(_encode(chunk, charset))
+                    data = buf.pop()
+                    if data:
+                        yield data
+    # The archive is closed: write out the last data and the central directory
+    yield buf.pop()
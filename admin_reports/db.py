@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+from contextlib import contextmanager
+
+import six
+from django.db import DatabaseError, connections
+
+try:
+    monotonic = time.monotonic
+except AttributeError:  # python 2
+    monotonic = time.time
+
+
+class ReportAborted(Exception):
+    """ The report was stopped before completion; the message tells the
+    user why.
+    """
+
+
+class ReportTimeout(ReportAborted):
+    pass
+
+
+class QueryBudget(object):
+    """ Limit the time the queries of a report can take on a database.
+
+    The budget starts when the first query runs; every query run on
+    ``alias`` while the budget is active gets a statement timeout equal to
+    the time left, where the backend supports it, and ``ReportTimeout`` is
+    raised once the time is over.
+    """
+
+    # How early a backend is allowed to cancel a statement, in seconds
+    slack = 0.05
+
+    def __init__(self, alias, timeout):
+        self.alias = alias
+        self.timeout = timeout
+        self.deadline = None
+
+    def remaining(self):
+        if self.deadline is None:
+            self.deadline = monotonic() + self.timeout
+        return self.deadline - monotonic()
+
+    def _timeout(self):
+        return ReportTimeout(
+            "The report took more than %s seconds to compute, "
+            "please narrow down your search." % self.timeout
+        )
+
+    def _set_statement_timeout(self, connection, remaining):
+        if connection.vendor == "sqlite":
+            deadline = self.deadline
+            connection.connection.set_progress_handler(
+                lambda: int(monotonic() > deadline), 1000
+            )
+        elif connection.vendor == "postgresql":
+            with connection.connection.cursor() as cursor:
+                cursor.execute("SET statement_timeout = %d" % (remaining * 1000))
+        elif connection.vendor == "mysql":
+            with connection.connection.cursor() as cursor:
+                cursor.execute(
+                    "SET SESSION max_execution_time = %d" % (remaining * 1000)
+                )
+
+    def _reset_statement_timeout(self, connection):
+        if connection.connection is None:
+            return
+        try:
+            if connection.vendor == "sqlite":
+                connection.connection.set_progress_handler(None, 1000)
+            elif connection.vendor == "postgresql":
+                with connection.connection.cursor() as cursor:
+                    cursor.execute("SET statement_timeout TO DEFAULT")
+            elif connection.vendor == "mysql":
+                with connection.connection.cursor() as cursor:
+                    cursor.execute("SET SESSION max_execution_time = DEFAULT")
+        except connection.Database.Error:
+            # e.g. inside a transaction aborted by the timeout
+            pass
+
+    def __call__(self, execute, sql, params, many, context):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise self._timeout()
+        self._set_statement_timeout(context["connection"], remaining)
+        try:
+            return execute(sql, params, many, context)
+        except DatabaseError as e:
+            if self.remaining() <= self.slack:
+                six.raise_from(self._timeout(), e)
+            raise
+
+    @contextmanager
+    def activate(self):
+        connection = connections[self.alias]
+        with connection.execute_wrapper(self):
+            try:
+                yield
+            finally:
+                self._reset_statement_timeout(connection)
@@ -23,6 +23,9 @@ class ExportForm(forms.Form):
         )
     )
     escapechar = forms.ChoiceField(choices=(("", ""), ("\\", "\\")), required=False)
+    compression = forms.ChoiceField(
+        choices=(("", "None"), ("gzip", "gzip"), ("zip", "zip")), required=False
+    )
 
     def clean_quoting(self):
         quoting = self.cleaned_data.get("quoting")
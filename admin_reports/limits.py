@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connections
+from django.template.defaultfilters import filesizeformat
+
+from .db import ReportAborted
+from .signals import limit_approached
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+# Memory tracing is process wide: it is started for the first report that
+# needs it and stopped after the last one, unless it was running already.
+_tracing = {"users": 0, "started": False}
+_tracing_lock = threading.Lock()
+
+
+class ReportTooLarge(ReportAborted):
+    pass
+
+
+class ReportLimits(object):
+    """ Abort a report that goes over ``max_rows`` records, ``max_memory``
+    bytes allocated or ``max_queries`` queries.
+
+    Queries are counted while the limits are active and memory is measured
+    inside ``trace_memory`` blocks; the first time a value reaches
+    ``warning_ratio`` of its limit a warning is logged and the
+    ``limit_approached`` signal is sent.
+    """
+
+    warning_ratio = 0.8
+    # Records between two memory checks
+    memory_interval = 1000
+
+    messages = {
+        "rows": "The report has more than %s records",
+        "memory": "The report needs more than %s of memory",
+        "queries": "The report runs more than %s queries",
+    }
+
+    def __init__(
+        self, report, alias, max_rows=None, max_memory=None, max_queries=None
+    ):
+        self.report = report
+        self.alias = alias
+        self.maxima = {"rows": max_rows, "memory": max_memory, "queries": max_queries}
+        self.queries = 0
+        self._warned = set()
+        self._baseline = None
+
+    def _format(self, limit, value):
+        if limit == "memory":
+            return filesizeformat(value)
+        return value
+
+    def check(self, limit, value):
+        maximum = self.maxima[limit]
+        if maximum is None:
+            return
+        if value > maximum:
+            raise ReportTooLarge(
+                "%s, please narrow down your search."
+                % (self.messages[limit] % self._format(limit, maximum))
+            )
+        if value >= maximum * self.warning_ratio and limit not in self._warned:
+            self._warned.add(limit)
+            logger.warning(
+                "Report %s is close to its %s limit: %s of %s",
+                self.report.__class__.__name__,
+                limit,
+                self._format(limit, value),
+                self._format(limit, maximum),
+            )
+            limit_approached.send(
+                sender=self.report.__class__,
+                report=self.report,
+                limit=limit,
+                value=value,
+                maximum=maximum,
+            )
+
+    def check_rows(self, count):
+        self.check("rows", count)
+
+    def check_memory(self):
+        """ Check the memory allocated since the outermost ``trace_memory``
+        block started; a no-op outside of them.
+        """
+        if self._baseline is not None:
+            self.check("memory", tracemalloc.get_traced_memory()[0] - self._baseline)
+
+    def watch(self, records):
+        """ Yield ``records``, checking the row limit for each of them and
+        the memory limit every ``memory_interval`` records.
+        """
+        for count, record in enumerate(records, 1):
+            self.check_rows(count)
+            if not count % self.memory_interval:
+                self.check_memory()
+            yield record
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        self.check("queries", self.queries)
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def trace_memory(self):
+        """ Measure the memory allocated while the block runs; nested blocks
+        share the baseline of the outermost one.
+        """
+        if (
+            self.maxima["memory"] is None
+            or tracemalloc is None
+            or self._baseline is not None
+        ):
+            yield
+            return
+        with _tracing_lock:
+            if not _tracing["users"] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracing["started"] = True
+            _tracing["users"] += 1
+        self._baseline = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            self._baseline = None
+            with _tracing_lock:
+                _tracing["users"] -= 1
+                if not _tracing["users"] and _tracing["started"]:
+                    tracemalloc.stop()
+                    _tracing["started"] = False
+
+    @contextmanager
+    def activate(self):
+        if self.maxima["queries"] is None:
+            yield
+        else:
+            with connections[self.alias].execute_wrapper(self):
+                yield
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import six
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from admin_reports.sites import site
+
+
+def warm(report_class, params):
+    """ Evaluate a report, filling its results, count and totals caches,
+    and return the time it took.
+    """
+    start = time.time()
+    try:
+        report = report_class()
+        report.set_params(**params)
+        with report.trace_memory(), report.guard():
+            len(report)
+            if report.get_has_totals():
+                report.get_totals()
+    finally:
+        # Each worker thread has its own connections
+        connections.close_all()
+    return time.time() - start
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the cache of the registered reports for their warm parameter "
+        "sets (the initial ones plus Report.warm_params)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "reports",
+            nargs="*",
+            help="Names or dotted paths of the reports to warm up (default: all).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of reports evaluated in parallel (default: 4).",
+        )
+
+    def get_report_classes(self, names):
+        report_classes = []
+        for report_class in site._registry:
+            if isinstance(report_class, six.string_types):
+                report_class = import_string(report_class)
+            path = "%s.%s" % (report_class.__module__, report_class.__name__)
+            if not names or report_class.__name__ in names or path in names:
+                report_classes.append(report_class)
+        return report_classes
+
+    def clean_params(self, report, params):
+        """ Clean ``params`` with the report form, as the report view does.
+        """
+        form_class = report.get_form_class()
+        if form_class is None:
+            return params
+        form = form_class(data=params)
+        if not form.is_valid():
+            return None
+        return form.cleaned_data
+
+    def log_result(self, future, report_class, params):
+        """ Print the outcome of a warm-up job; return whether it succeeded.
+        """
+        try:
+            elapsed = future.result()
+        except Exception as e:
+            self.stderr.write("%s %r failed: %s" % (report_class.__name__, params, e))
+            return False
+        self.stdout.write(
+            "%s %r warmed in %.2fs" % (report_class.__name__, params, elapsed)
+        )
+        return True
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        # Memory is measured for the whole process: reports with a memory
+        # limit are warmed one at a time, once the others are done, so
+        # that they are not charged for each other's allocations.
+        parallel = []
+        serial = []
+        for report_class in self.get_report_classes(options["reports"]):
+            report = report_class()
+            if report.get_cache_timeout() is None:
+                if options["verbosity"] > 1:
+                    self.stdout.write(
+                        "%s is not cached, skipped" % report_class.__name__
+                    )
+                continue
+            for params in report.get_warm_params():
+                cleaned = self.clean_params(report, params)
+                if cleaned is None:
+                    self.stderr.write(
+                        "%s: invalid parameters %r, skipped"
+                        % (report_class.__name__, params)
+                    )
+                    continue
+                if report.get_max_memory() is None:
+                    parallel.append((report_class, cleaned))
+                else:
+                    serial.append((report_class, cleaned))
+
+        total = len(parallel) + len(serial)
+        failures = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            futures = dict(
+                (executor.submit(warm, report_class, params), (report_class, params))
+                for report_class, params in parallel
+            )
+            for future in as_completed(futures):
+                if not self.log_result(future, *futures[future]):
+                    failures += 1
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for report_class, params in serial:
+                future = executor.submit(warm, report_class, params)
+                if not self.log_result(future, report_class, params):
+                    failures += 1
+        if failures:
+            raise CommandError(
+                "%d of %d report evaluations failed" % (failures, total)
+            )
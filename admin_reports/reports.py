@@ -5,27 +5,59 @@ import logging
 import six
 import csv
 import re
+from contextlib import contextmanager
 from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
 
 try:
     from django.db.models.query import QuerySet, ValuesQuerySet
 except ImportError:
     # django >= 1.9 does not have ValuesQuerySet anymore
     from django.db.models.query import QuerySet, ModelIterable
+from django.db.models.query import RawQuerySet
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.core.paginator import Paginator
-
-try:
-    pnd = True
-    from pandas import DataFrame
-except ImportError:
-    pnd = False
+from .backends import get_backend, is_dataframe
+from .cache import make_key
+from .db import QueryBudget
 from .forms import ExportForm
+from .limits import ReportLimits
+from .results import IterResults, IterPaginator
+from .spill import SpillResults
+from .totals import (
+    SubtotalRecord,
+    group_records,
+    insert_subtotals,
+    make_db_aggregate,
+    make_reducer,
+)
 
 logger = logging.getLogger(__name__)
 camel_re = re.compile("([a-z0-9])([A-Z])")
 
 
+class _Echo(object):
+    """ File-like object whose ``write`` returns the value instead of
+    storing it, to let ``csv.writer`` feed a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+@contextmanager
+def _no_budget():
+    yield
+
+
+def _frame_records(frame, chunk_size=1000):
+    for start in range(0, frame.index.size, chunk_size):
+        for record in frame.iloc[start : start + chunk_size].to_dict(orient="records"):
+            yield record
+
+
 class Report(object):
     fields = None
     formatting = None
@@ -43,6 +75,17 @@ class Report(object):
     export_form_class = ExportForm
     initial = {}
     auto_totals = None
+    group_by = None
+    subtotals = None
+    spill_threshold = None
+    using = None
+    query_timeout = None
+    cache_timeout = None
+    cache_alias = "default"
+    warm_params = None
+    max_rows = None
+    max_memory = None
+    max_queries = None
 
     def __init__(self, *args, **kwargs):
         self.set_sort_params()
@@ -50,19 +93,54 @@ class Report(object):
         self._data_type = "list"
         self._results = []
         self._totals = {}
+        self._grouped = None
+        self._budget = None
+        self._limits = None
 
     def __len__(self):
+        count = self._cache_get("count")
+        if count is None:
+            count = self._count()
+            self._cache_set("count", count)
+        self._check_rows(count)
+        return count
+
+    def _count(self):
         if not self._evaluated:
             self._eval()
-        if self._data_type == "qs":
+        if isinstance(self._results, QuerySet):
+            # Values querysets too, which are typed "list"
             return self._results.count()
         elif self._data_type == "df":
             return self._results.index.size
+        elif self._data_type in ("iter", "lazy"):
+            return self._results.count()
         return len(self._results)
 
     def _split_totals(self, results):
-        if self.has_totals and (len(results) > 0) and (self.auto_totals is None):
-            if pnd and (self._data_type == "df"):
+        if self._data_type == "iter":
+            on_record = None
+            if self.has_totals and self.get_auto_totals() is None:
+                results = self._hold_totals(results)
+            elif self.has_totals:
+                self._reducers = self._get_reducers()
+                on_record = self._reduce_record
+            self._results = IterResults(results, on_record=on_record)
+            self._totals = {}
+        elif self._data_type == "lazy":
+            self._results = results
+            if self.has_totals and self.get_auto_totals() is None:
+                self._totals = results.split_last()
+                self._evaluated_totals = True
+            else:
+                self._totals = {}
+        elif (
+            self.has_totals
+            and (self.get_auto_totals() is None)
+            # Only now: len() fetches values querysets
+            and (len(results) > 0)
+        ):
+            if self._data_type == "df":
                 self._results = results.iloc[:-1]
                 self._totals = results.iloc[-1]
             elif self._data_type == "qs":
@@ -77,14 +155,60 @@ class Report(object):
             self._results = results
             self._totals = {}
 
+    def _hold_totals(self, results):
+        """ Yield all the records but the last one, which is kept as the
+        totals row once the iterator is exhausted.
+        """
+        last = missing = object()
+        for record in results:
+            if last is not missing:
+                yield last
+            last = record
+        if last is not missing:
+            self._totals = last
+        self._evaluated_totals = True
+
+    def _get_reducers(self):
+        return dict(
+            (field_name, make_reducer(func))
+            for field_name, func in self.get_auto_totals().items()
+            if func
+        )
+
+    def _reduce_record(self, record):
+        for field_name, reducer in self._reducers.items():
+            reducer.add(record[field_name])
+
+    def _get_ordering(self):
+        """ Return the sort params, preceded by the ``group_by`` fields if
+        the report has subtotals.
+        """
+        group_by = self.get_group_by()
+        if not group_by:
+            return self._sort_params
+        ordering = []
+        for field_name in group_by:
+            # Keep the direction requested for the field, if any
+            for param in self._sort_params:
+                if param.lstrip("-") == field_name:
+                    ordering.append(param)
+                    break
+            else:
+                ordering.append(field_name)
+        return tuple(ordering) + tuple(
+            param for param in self._sort_params if param.lstrip("-") not in group_by
+        )
+
     def _sort_results(self):
-        if self._data_type == "qs":
-            if self._sort_params:
-                self._results = self._results.order_by(*self._sort_params)
+        sort_params = self._get_ordering()
+        self._grouped = None
+        if self._data_type == "qs" or self._is_unsliced_qs(self._results):
+            if sort_params:
+                self._results = self._results.order_by(*sort_params)
         elif self._data_type == "df":
             columns = []
             ascending = []
-            for param in self._sort_params:
+            for param in sort_params:
                 if param.startswith("-"):
                     ascending.append(0)
                     columns.append(param.replace("-", "", 1))
@@ -93,8 +217,26 @@ class Report(object):
                     columns.append(param)
             if columns:
                 self._results = self._results.sort_values(columns, ascending=ascending)
+        elif self._data_type in ("spill", "lazy"):
+            self._results.sort(sort_params)
+        elif self._data_type == "iter":
+            threshold = self.get_spill_threshold()
+            if sort_params and threshold is not None:
+                self._results.fill(threshold + 1)
+                if not self._results.exhausted:
+                    self._results = SpillResults(self._results.stream())
+                    self._data_type = "spill"
+                    self._results.sort(sort_params)
+                    self._sorted = True
+                    return
+            for param in reversed(sort_params):
+                reverse = False
+                if param.startswith("-"):
+                    reverse = True
+                    param = param.replace("-", "", 1)
+                self._results.sort(key=lambda x: x[param], reverse=reverse)
         else:
-            for param in reversed(self._sort_params):
+            for param in reversed(sort_params):
                 reverse = False
                 if param.startswith("-"):
                     reverse = True
@@ -105,36 +247,175 @@ class Report(object):
         self._sorted = True
 
     def _eval(self):
-        results = self.aggregate(**self._params)
+        # New results: they need sorting and grouping again
+        self._sorted = False
+        self._grouped = None
+        results = self._cache_get("results")
+        if results is None:
+            results = self.aggregate(**self._params)
+            self._check_memory()
+            if isinstance(results, (list, tuple)) or is_dataframe(results):
+                self._cache_set("results", results)
+        alias = self.get_db_alias()
+        if alias is not None and isinstance(results, (QuerySet, RawQuerySet)):
+            results = results.using(alias)
+        backend = get_backend(results)
         try:
             values = isinstance(results, ValuesQuerySet)
         except NameError:  # django >= 1.9
             values = results.__class__ is not ModelIterable
+        max_rows = self.get_max_rows()
         if isinstance(results, QuerySet) and not values:
             self._data_type = "qs"
-        elif pnd and isinstance(results, DataFrame):
+        elif is_dataframe(results):
             self._data_type = "df"
+            self._check_rows(results.index.size)
+        elif backend is not None:
+            self._data_type = "lazy"
+            results = backend(results)
+            if max_rows is not None:
+                self._check_rows(results.count())
+        elif not isinstance(results, (list, tuple)) and not hasattr(
+            results, "__len__"
+        ):
+            # A generator or any other lazy iterable
+            self._data_type = "iter"
+            limits = self.get_limits()
+            if limits is not None:
+                results = limits.watch(results)
+        else:
+            self._data_type = "list"
+            if isinstance(results, (list, tuple)) and max_rows is not None:
+                self._check_rows(len(results))
+        if isinstance(results, QuerySet) and max_rows is not None:
+            # Values querysets too, which are typed "list"
+            self._check_rows(results.count())
         self._split_totals(results)
+        self._spill()
         self._evaluated = True
 
+    def _spill(self):
+        """ Move list and DataFrame results bigger than ``spill_threshold``
+        records to a temporary SQLite table.
+        """
+        threshold = self.get_spill_threshold()
+        if threshold is None:
+            return
+        if (
+            self._data_type == "list"
+            # Values and raw querysets are paged by the database
+            and isinstance(self._results, (list, tuple))
+            and len(self._results) > threshold
+        ):
+            self._results = SpillResults(self._results)
+        elif self._data_type == "df" and self._results.index.size > threshold:
+            self._results = SpillResults(_frame_records(self._results))
+            if hasattr(self._totals, "to_dict"):
+                self._totals = self._totals.to_dict()
+        else:
+            return
+        self._data_type = "spill"
+
+    def _get_db_aggregates(self, functions):
+        """ Return the database aggregates computing ``functions`` as
+        ``(alias, field_name, aggregate)`` triples, or ``None`` if some of
+        them can't be computed by the database.
+        """
+        annotations = self._results.query.annotations.values()
+        if any(getattr(a, "contains_aggregate", False) for a in annotations):
+            # Results are aggregated already
+            return None
+        aggregates = []
+        for idx, (field_name, func) in enumerate(functions.items()):
+            if not func:
+                continue
+            aggregate = make_db_aggregate(field_name, func)
+            if aggregate is None:
+                return None
+            aggregates.append(("total_%d" % idx, field_name, aggregate))
+        return aggregates
+
     def _eval_totals(self):
-        if self._data_type == "qs":
+        aggregates = None
+        if self._data_type == "qs" or self._is_unsliced_qs(self._results):
+            aggregates = self._get_db_aggregates(self.get_auto_totals())
+        if aggregates is not None:
+            values = self._results.aggregate(
+                **dict((alias, aggregate) for alias, _, aggregate in aggregates)
+            )
+            for alias, field_name, _ in aggregates:
+                self._totals[field_name] = values[alias]
+        elif self._data_type == "qs":
             # TODO
             pass
-        elif pnd and self._data_type == "df":
-            self._totals = self._results.agg(self.auto_totals)
+        elif self._data_type == "df":
+            self._totals = self._results.agg(self.get_auto_totals())
+        elif self._data_type == "lazy":
+            self._totals = self._results.totals(self.get_auto_totals())
         else:
-            for field_name, _ in self.get_fields():
-                func = self.auto_totals.get(field_name, False)
-                if func:
-                    self._totals[field_name] = func(
-                        [row[field_name] for row in self._results]
-                    )
-                # else:
-                #     self._totals[field_name] = ""
+            if self._data_type == "iter":
+                # Records have been fed to the reducers while being pulled
+                self._results.drain()
+            else:
+                self._reducers = self._get_reducers()
+                for record in self._results:
+                    self._reduce_record(record)
+            for field_name, reducer in self._reducers.items():
+                self._totals[field_name] = reducer.result()
+        self._evaluated_totals = True
+
+    def _group_results(self):
+        """ Return the sorted records with a subtotals record after each
+        group.
+        """
+        group_by = self.get_group_by()
+        subtotals = self.get_subtotals()
+        results = self._results
+        if self._is_unsliced_qs(results):
+            aggregates = self._get_db_aggregates(subtotals)
+            if self._data_type == "qs" and not self._is_value_qs(results):
+                results = results.values()
+            if aggregates is not None:
+                # One GROUP BY query for each level of group_by
+                lookup = {}
+                annotations = dict((alias, agg) for alias, _, agg in aggregates)
+                for level in range(1, len(group_by) + 1):
+                    fields = group_by[:level]
+                    rows = results.order_by().values(*fields).annotate(**annotations)
+                    for row in rows:
+                        lookup[tuple(row[f] for f in fields)] = dict(
+                            (field_name, row[alias])
+                            for alias, field_name, _ in aggregates
+                        )
+                return IterResults(
+                    insert_subtotals(results.iterator(), group_by, lookup)
+                )
+            return IterResults(group_records(results.iterator(), group_by, subtotals))
+        elif self._data_type == "df":
+            lookup = {}
+            for level in range(1, len(group_by) + 1):
+                fields = list(group_by[:level])
+                frame = results.groupby(fields, sort=False).agg(subtotals)
+                for key, row in frame.iterrows():
+                    if not isinstance(key, tuple):
+                        key = (key,)
+                    lookup[key] = row.to_dict()
+            return IterResults(
+                insert_subtotals(_frame_records(results), group_by, lookup)
+            )
+        elif self._data_type == "list":
+            on_totals = None
+            if self.has_totals and self.auto_totals is None:
+                on_totals = self._set_grand_totals
+            return list(group_records(results, group_by, subtotals, on_totals))
+        return IterResults(group_records(iter(results), group_by, subtotals))
+
+    def _set_grand_totals(self, totals):
+        self._totals = totals
         self._evaluated_totals = True
 
     def _items(self, record):
+        subtotal = isinstance(record, SubtotalRecord)
         for field_name, _ in self.get_fields():
             # Does the field_name refer to an aggregation column or is
             # it an attribute of this instance?
@@ -142,6 +423,10 @@ class Report(object):
                 attr_field = getattr(self, field_name)
             except AttributeError:
                 # The field is a record element
+                if subtotal and field_name not in record:
+                    # Left blank, like the fields missing from the totals
+                    yield ""
+                    continue
                 ret = record.get(field_name)
                 formatting_func = self.get_formatting().get(field_name)
                 if formatting_func is not None:
@@ -151,7 +436,9 @@ class Report(object):
                         pass
             else:
                 # The view class has an attribute with this field_name
-                if callable(attr_field):
+                if subtotal:
+                    ret = ""
+                elif callable(attr_field):
                     ret = attr_field(record)
                     if getattr(attr_field, "allow_tags", False):
                         ret = mark_safe(ret)
@@ -167,6 +454,10 @@ class Report(object):
             self._eval()
         if not self._sorted:
             self._sort_results()
+        if self.get_group_by():
+            if self._grouped is None:
+                self._grouped = self._group_results()
+            return self._grouped
         if self._data_type == "qs":
             if not self._is_value_qs(self._results):
                 return self._results.values()
@@ -180,8 +471,16 @@ class Report(object):
         if self.has_totals:
             if not self._evaluated:
                 self._eval()
-            if not self._evaluated_totals and self.auto_totals is not None:
+            if not self._evaluated_totals and self.get_auto_totals() is not None:
+                totals = self._cache_get("totals")
+                if totals is not None:
+                    self._totals = totals
+                    self._evaluated_totals = True
+            if self._data_type == "iter" and not self._evaluated_totals:
+                self._results.drain()
+            if not self._evaluated_totals and self.get_auto_totals() is not None:
                 self._eval_totals()
+                self._cache_set("totals", self._totals)
         if self._data_type == "qs":
             totals_dict = dict(self._totals)
         elif self._data_type == "df":
@@ -207,6 +506,9 @@ class Report(object):
             except KeyError:
                 return "align-left"
 
+    def _is_unsliced_qs(self, results):
+        return isinstance(results, QuerySet) and results.query.can_filter()
+
     def _is_value_qs(self, results):
         if hasattr(results.query, "values_select"):
             return results.query.values_select
@@ -216,7 +518,7 @@ class Report(object):
         if not self._evaluated:
             self._eval()
         if self.fields is None:
-            if self._data_type == "df":
+            if self._data_type in ("df", "lazy"):
                 self.fields = self._results.columns
             elif self._data_type == "qs":
                 values = self._is_value_qs(self._results)
@@ -274,7 +576,25 @@ class Report(object):
         return self.has_totals
 
     def get_paginator(self):
-        return self.paginator(self.results, self.get_list_per_page())
+        results = self.get_results()
+        if isinstance(results, IterResults):
+            return IterPaginator(results, self.get_list_per_page())
+        paginator = self.paginator(results, self.get_list_per_page())
+        if self.get_cache_timeout() is not None and not self.get_group_by():
+            # Take the count from the cache
+            paginator.count = len(self)
+        return paginator
+
+    def get_record_count(self):
+        """ Return the number of records, subtotal rows excluded, and
+        whether it is final: iterators only know how many records they
+        yielded so far.
+        """
+        if not self._evaluated:
+            self._eval()
+        if self._data_type == "iter":
+            return self._results.seen, self._results.exhausted
+        return len(self), True
 
     def get_list_max_show_all(self):
         return self.list_max_show_all
@@ -282,11 +602,161 @@ class Report(object):
     def get_list_per_page(self):
         return self.list_per_page
 
+    def get_group_by(self):
+        if isinstance(self.group_by, six.string_types):
+            return (self.group_by,)
+        return tuple(self.group_by or ())
+
+    def get_subtotals(self):
+        if self.subtotals is not None:
+            return self.subtotals
+        return self.auto_totals or {}
+
+    def get_auto_totals(self):
+        """ Without ``auto_totals`` the grand totals of a report with
+        subtotals are computed with the same functions.
+        """
+        if self.auto_totals is None and self.get_group_by():
+            return self.get_subtotals()
+        return self.auto_totals
+
+    def get_spill_threshold(self):
+        return self.spill_threshold
+
+    def get_cache_timeout(self):
+        return self.cache_timeout
+
+    def get_cache(self):
+        return caches[self.cache_alias]
+
+    def _cache_get(self, name):
+        if self.get_cache_timeout() is None:
+            return None
+        return self.get_cache().get(make_key(self, name))
+
+    def _cache_set(self, name, value):
+        if self.get_cache_timeout() is not None:
+            self.get_cache().set(make_key(self, name), value, self.get_cache_timeout())
+
+    def get_warm_params(self):
+        """ The parameter sets the ``warm_reports`` command fills the cache
+        for: the initial ones plus ``warm_params``.
+        """
+        return [self.get_initial()] + list(self.warm_params or [])
+
+    def get_db_alias(self):
+        return self.using
+
+    def get_connection(self):
+        """ The connection raw SQL reports should run their queries on.
+        """
+        return connections[self.get_db_alias() or DEFAULT_DB_ALIAS]
+
+    def get_query_timeout(self):
+        return self.query_timeout
+
+    def query_budget(self):
+        """ Return a context manager that limits to ``query_timeout``
+        seconds the time spent in the queries of the report.
+        """
+        timeout = self.get_query_timeout()
+        if timeout is None:
+            return _no_budget()
+        if self._budget is None:
+            self._budget = QueryBudget(
+                self.get_db_alias() or DEFAULT_DB_ALIAS, timeout
+            )
+        return self._budget.activate()
+
+    def get_max_rows(self):
+        return self.max_rows
+
+    def get_max_memory(self):
+        return self.max_memory
+
+    def get_max_queries(self):
+        return self.max_queries
+
+    def get_limits(self):
+        """ Return the ``ReportLimits`` enforcing ``max_rows``, ``max_memory``
+        and ``max_queries``, or ``None`` if the report has no limits.
+        """
+        if self._limits is None:
+            maxima = (
+                self.get_max_rows(),
+                self.get_max_memory(),
+                self.get_max_queries(),
+            )
+            if all(maximum is None for maximum in maxima):
+                return None
+            self._limits = ReportLimits(
+                self, self.get_db_alias() or DEFAULT_DB_ALIAS, *maxima
+            )
+        return self._limits
+
+    def check_max_rows(self):
+        """ Raise ``ReportTooLarge`` if the report has more than
+        ``max_rows`` records, before anything is rendered: iterators are
+        pulled up to ``max_rows + 1`` records, the other results are
+        checked when they are evaluated.
+        """
+        max_rows = self.get_max_rows()
+        if max_rows is None:
+            return
+        if not self._evaluated:
+            self._eval()
+        if self._data_type == "iter":
+            self._results.fill(max_rows + 1)
+        elif isinstance(self._results, RawQuerySet):
+            # Raw querysets can't be counted; the paginator fetches them
+            # all anyway and they keep their records
+            self._check_rows(len(self._results))
+
+    def _check_rows(self, count):
+        limits = self.get_limits()
+        if limits is not None:
+            limits.check_rows(count)
+
+    def _check_memory(self):
+        limits = self.get_limits()
+        if limits is not None:
+            limits.check_memory()
+
+    def trace_memory(self):
+        """ Return a context manager measuring, against ``max_memory``, the
+        memory allocated while it is active. It is meant to wrap a whole
+        response, and the ``guard`` blocks of its steps.
+        """
+        limits = self.get_limits()
+        if limits is None:
+            return _no_budget()
+        return limits.trace_memory()
+
+    @contextmanager
+    def guard(self):
+        """ Keep the report within its query budget and query limit while
+        the block runs; memory is measured by ``trace_memory``.
+        """
+        limits = self.get_limits()
+        with self.query_budget():
+            if limits is None:
+                yield
+            else:
+                with limits.activate():
+                    yield
+
     def get_export_form_class(self):
         return self.export_form_class
 
-    def iter_results(self):
-        for record in self.get_results():
+    def iter_results(self, records=None):
+        if records is None:
+            records = self.get_results()
+            if isinstance(records, IterResults):
+                records = records.stream()
+        limits = self.get_limits()
+        if limits is not None:
+            records = limits.watch(records)
+        for record in records:
             yield self._items(record)
 
     @property
@@ -306,41 +776,44 @@ class Report(object):
         """
         raise NotImplementedError("Subclasses must implement this method")
 
-    def to_csv(
+    def _csv_writer(
         self,
         fileobj,
-        header=False,
-        totals=False,
         delimiter=";",
         quotechar='"',
         quoting=csv.QUOTE_NONNUMERIC,
         escapechar="",
-        extra_rows=None,
         **kwargs
     ):
-        writer = csv.writer(
+        return csv.writer(
             fileobj,
             delimiter=str(delimiter),
             quotechar=str(quotechar),
             quoting=quoting,
-            escapechar=str(escapechar),
+            escapechar=str(escapechar) or None,
             **kwargs
         )
+
+    def _write_csv(self, writer, header=False, totals=False, extra_rows=None):
+        """ Write the report one row at a time, yielding whatever the
+        writer returns for each row.
+        """
         if extra_rows is not None:
-            writer.writerows(extra_rows)
+            for row in extra_rows:
+                yield writer.writerow(row)
         if header:
             if six.PY2:
-                writer.writerow(
+                yield writer.writerow(
                     [
                         name.encode(settings.DEFAULT_CHARSET)
                         for name, _ in self.get_fields()
                     ]
                 )
             else:
-                writer.writerow([name for name, _ in self.get_fields()])
+                yield writer.writerow([name for name, _ in self.get_fields()])
         for record in self.iter_results():
             if six.PY2:
-                writer.writerow(
+                yield writer.writerow(
                     [
                         elem.encode(settings.DEFAULT_CHARSET)
                         if isinstance(elem, six.text_type)
@@ -349,9 +822,34 @@ class Report(object):
                     ]
                 )
             else:
-                writer.writerow(record)
+                yield writer.writerow(record)
         if totals and self.get_has_totals():
-            writer.writerow(self.totals)
+            yield writer.writerow(self.totals)
+
+    def to_csv(
+        self, fileobj, header=False, totals=False, extra_rows=None, **kwargs
+    ):
+        writer = self._csv_writer(fileobj, **kwargs)
+        for _ in self._write_csv(writer, header, totals, extra_rows):
+            pass
+
+    def iter_csv(self, header=False, totals=False, extra_rows=None, **kwargs):
+        """ Return a generator of CSV lines, suitable for a
+        ``StreamingHttpResponse``.
+        """
+        writer = self._csv_writer(_Echo(), **kwargs)
+        return self._write_csv(writer, header, totals, extra_rows)
+
+    def get_export_metadata(self, **options):
+        """ Describe an export; bundled with the data in zip archives.
+        """
+        return {
+            "title": self.get_title(),
+            "params": self._params,
+            "sort": list(self.get_sort_params()),
+            "options": options,
+            "created": timezone.now(),
+        }
 
     def has_permission(self, request):
         return request.user.is_active and request.user.is_staff
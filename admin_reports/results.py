@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.paginator import Paginator
+
+
+class ResultsConsumed(Exception):
+    pass
+
+
+class IterResults(object):
+    """ Wrap the iterator returned by ``Report.aggregate`` so that records
+    are pulled from it only when they are needed.
+
+    Indexing and slicing cache the records pulled so far, ``stream`` and
+    ``drain`` go through the remaining records without keeping them in
+    memory. Every record pulled from the iterator is passed to
+    ``on_record``, if given, exactly once.
+    """
+
+    def __init__(self, iterable, on_record=None):
+        self._iterator = iter(iterable)
+        self._on_record = on_record
+        self._cache = []
+        self._consumed = False
+        self.exhausted = False
+        self.seen = 0
+
+    def _next(self):
+        try:
+            record = next(self._iterator)
+        except StopIteration:
+            self.exhausted = True
+            raise
+        self.seen += 1
+        if self._on_record is not None:
+            self._on_record(record)
+        return record
+
+    def fill(self, stop=None):
+        """ Cache records until there are ``stop`` of them, or all of them
+        if ``stop`` is ``None``.
+        """
+        if self._consumed and (stop is None or len(self._cache) < stop):
+            raise ResultsConsumed(
+                "Records past the first %d have already been consumed"
+                % len(self._cache)
+            )
+        while not self.exhausted and (stop is None or len(self._cache) < stop):
+            try:
+                self._cache.append(self._next())
+            except StopIteration:
+                break
+
+    def stream(self):
+        """ Yield every record, without caching the ones not pulled yet.
+        """
+        for record in self._cache:
+            yield record
+        while not self.exhausted:
+            try:
+                record = self._next()
+            except StopIteration:
+                break
+            self._consumed = True
+            yield record
+
+    def drain(self):
+        for _ in self.stream():
+            pass
+
+    def count(self):
+        self.drain()
+        return self.seen
+
+    def sort(self, key=None, reverse=False):
+        self.fill()
+        self._cache.sort(key=key, reverse=reverse)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0):
+                stop = None
+        elif key >= 0:
+            stop = key + 1
+        else:
+            stop = None
+        self.fill(stop)
+        return self._cache[key]
+
+    def __iter__(self):
+        index = 0
+        while True:
+            self.fill(index + 1)
+            if index >= len(self._cache):
+                return
+            yield self._cache[index]
+            index += 1
+
+    def __len__(self):
+        if self._consumed:
+            return self.count()
+        self.fill()
+        return len(self._cache)
+
+
+class IterPaginator(Paginator):
+    """ Paginate ``IterResults`` pulling only the records needed for the
+    requested page; until the iterator is exhausted ``count`` is the number
+    of records pulled so far.
+    """
+
+    def prefetch(self, stop):
+        self.object_list.fill(stop)
+
+    @property
+    def count(self):
+        return self.object_list.seen
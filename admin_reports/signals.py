@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.dispatch import Signal
+
+# Sent with the ``report``, the ``limit`` ("rows", "memory" or "queries"),
+# its current ``value`` and the ``maximum`` allowed, the first time a report
+# gets close to one of its limits.
+limit_approached = Signal()
@@ -1,5 +1,6 @@
 from __future__ import unicode_literals
 
+import six
 from django.apps import apps
 from django.conf.urls import url
 from django.contrib.admin.sites import site as admin_site
@@ -15,37 +16,55 @@ class NotRegistered(Exception):
     pass
 
 
+def _split_path(report):
+    """ Return the module and the name of a report class or dotted path.
+    """
+    if isinstance(report, six.string_types):
+        return tuple(report.rsplit(".", 1))
+    return report.__module__, report.__name__
+
+
 class AdminReportSite(object):
     def __init__(self, name="admin_reports"):
         self.name = name
         self._registry = []
 
+    def _is_registered(self, report):
+        path = _split_path(report)
+        return any(_split_path(registered) == path for registered in self._registry)
+
     def register(self, report):
-        if issubclass(report, Report):
-            if report in self._registry:
+        """ Register a ``Report`` subclass, or the dotted path to one to
+        import it only on the first request.
+        """
+        if isinstance(report, six.string_types) or issubclass(report, Report):
+            if self._is_registered(report):
                 raise AlreadyRegistered(
-                    "The report %s is already registered" % report.__name__
+                    "The report %s is already registered" % _split_path(report)[1]
                 )
             self._registry.append(report)
 
     def unregister(self, report):
-        if issubclass(report, Report):
-            if report not in self._registry:
-                raise NotRegistered("The report %s is not registered" % report.__name__)
-            self._registry.remove(report)
+        if isinstance(report, six.string_types) or issubclass(report, Report):
+            path = _split_path(report)
+            for registered in self._registry:
+                if _split_path(registered) == path:
+                    self._registry.remove(registered)
+                    break
+            else:
+                raise NotRegistered("The report %s is not registered" % path[1])
 
     def get_urls(self):
         urlpatterns = []
 
         for report in self._registry:
-            app_name = apps.get_containing_app_config(report.__module__).name
+            module, name = _split_path(report)
+            app_name = apps.get_containing_app_config(module).name
             urlpatterns.append(
                 url(
-                    r"^{0}/{1}/$".format(
-                        app_name.replace(".", "_"), report.__name__.lower()
-                    ),
+                    r"^{0}/{1}/$".format(app_name.replace(".", "_"), name.lower()),
                     admin_site.admin_view(ReportView.as_view(report_class=report)),
-                    name=camel_re.sub(r"\1_\2", report.__name__).lower(),
+                    name=camel_re.sub(r"\1_\2", name).lower(),
                 )
             )
         return urlpatterns
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pickle
+import sqlite3
+from collections import OrderedDict
+from decimal import Decimal
+
+import six
+
+
+def _sort_value(value):
+    """ Return a value SQLite can store and that sorts like ``value``.
+    """
+    if value is None or isinstance(
+        value, (bool, float, six.integer_types, six.text_type, six.binary_type)
+    ):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "isoformat"):
+        # date, time and datetime
+        return value.isoformat()
+    return six.text_type(value)
+
+
+class SpillResults(object):
+    """ Records stored in a temporary on-disk SQLite table, for results too
+    big to be sorted and paginated in memory.
+
+    Each record is pickled along with one column per field, used only for
+    sorting; indexes on these columns are created the first time a sort
+    needs them. The database is deleted when the connection is closed.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, records):
+        self._connection = sqlite3.connect("", check_same_thread=False)
+        self._columns = None
+        self._order = " ORDER BY id"
+        self._count = 0
+        self._load(records)
+
+    def _create_table(self, record):
+        self._columns = OrderedDict(
+            (name, "c%d" % idx) for idx, name in enumerate(record)
+        )
+        self._connection.execute(
+            "CREATE TABLE records (id INTEGER PRIMARY KEY, data BLOB%s)"
+            % "".join(", %s" % column for column in self._columns.values())
+        )
+
+    def _load(self, records):
+        insert = None
+        batch = []
+        for record in records:
+            if self._columns is None:
+                self._create_table(record)
+                insert = "INSERT INTO records VALUES (NULL, ?%s)" % (
+                    ", ?" * len(self._columns)
+                )
+            batch.append(
+                [sqlite3.Binary(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))]
+                + [_sort_value(record.get(name)) for name in self._columns]
+            )
+            if len(batch) >= self.batch_size:
+                self._connection.executemany(insert, batch)
+                self._count += len(batch)
+                batch = []
+        if self._columns is None:
+            self._create_table({})
+        if batch:
+            self._connection.executemany(insert, batch)
+            self._count += len(batch)
+        self._connection.commit()
+
+    def _select(self, limit=-1, offset=0):
+        cursor = self._connection.execute(
+            "SELECT data FROM records%s LIMIT ? OFFSET ?" % self._order,
+            (limit, offset),
+        )
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield pickle.loads(bytes(row[0]))
+
+    def sort(self, sort_params):
+        """ Sort by ``sort_params``, field names optionally prefixed by
+        ``-`` for descending order.
+        """
+        terms = []
+        for param in sort_params:
+            if param.startswith("-"):
+                terms.append("%s DESC" % self._columns[param[1:]])
+            else:
+                terms.append(self._columns[param])
+        if terms:
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_%s ON records (%s)"
+                % ("_".join(term.replace(" ", "_") for term in terms), ", ".join(terms))
+            )
+        # id keeps the sort stable, as sorted() would
+        self._order = " ORDER BY %s" % ", ".join(terms + ["id"])
+
+    def stream(self):
+        return self._select()
+
+    def count(self):
+        return self._count
+
+    def close(self):
+        self._connection.close()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._count)
+            records = list(self._select(max(stop - start, 0), start))
+            return records[::step] if step != 1 else records
+        if key < 0:
+            key += self._count
+        if not 0 <= key < self._count:
+            raise IndexError("SpillResults index out of range")
+        return next(self._select(1, key))
+
+    def __iter__(self):
+        return self._select()
+
+    def __len__(self):
+        return self._count
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db.models import Aggregate, Avg, Count, Max, Min, Sum
+
+
+class Reducer(object):
+    """ Fold the values of a column into a total, one value at a time.
+    """
+
+    def add(self, value):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def result(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+
+class ListReducer(Reducer):
+    """ Fallback for plain callables: collect the column values and pass
+    them all to ``func`` at the end.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def result(self):
+        return self.func(self.values)
+
+
+class SumReducer(Reducer):
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        self.total += value
+
+    def result(self):
+        return self.total
+
+
+class CountReducer(Reducer):
+    """ Count the values, like ``len``.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+
+    def result(self):
+        return self.count
+
+
+class CountValuesReducer(CountReducer):
+    """ Count the values that are not null, like pandas ``"count"``.
+    """
+
+    def add(self, value):
+        # NaN is the only value not equal to itself
+        if value is not None and value == value:
+            self.count += 1
+
+
+class MinReducer(Reducer):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+
+class MaxReducer(Reducer):
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+    def result(self):
+        return self.value
+
+
+class MeanReducer(Reducer):
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def result(self):
+        if self.count:
+            return self.total / self.count
+        return None
+
+
+streaming_reducers = {
+    sum: SumReducer,
+    len: CountReducer,
+    min: MinReducer,
+    max: MaxReducer,
+    # pandas aggregation names, for DataFrame reports spilled to disk
+    "sum": SumReducer,
+    "count": CountValuesReducer,
+    "min": MinReducer,
+    "max": MaxReducer,
+    "mean": MeanReducer,
+}
+
+
+def make_reducer(func):
+    """ Return a ``Reducer`` instance for an ``auto_totals`` entry.
+
+    ``func`` can be a ``Reducer`` subclass or any callable accepting a
+    list of values; ``sum``, ``len``, ``min`` and ``max`` are replaced
+    by their streaming counterparts.
+    """
+    if isinstance(func, type) and issubclass(func, Reducer):
+        return func()
+    reducer_class = streaming_reducers.get(func)
+    if reducer_class is not None:
+        return reducer_class()
+    return ListReducer(func)
+
+
+db_aggregates = {
+    sum: Sum,
+    min: Min,
+    max: Max,
+    "sum": Sum,
+    "count": Count,
+    "min": Min,
+    "max": Max,
+    "mean": Avg,
+}
+
+
+def make_db_aggregate(field_name, func):
+    """ Return the database ``Aggregate`` computing ``func`` over
+    ``field_name``, or ``None`` if there is none.
+    """
+    if isinstance(func, type) and issubclass(func, Aggregate):
+        return func(field_name)
+    if func is len:
+        # Every row, like len() of the column values; "count" skips nulls
+        return Count("*")
+    aggregate_class = db_aggregates.get(func)
+    if aggregate_class is not None:
+        return aggregate_class(field_name)
+    return None
+
+
+class SubtotalRecord(dict):
+    """ A record holding the subtotals of a group of records.
+
+    ``level`` is the number of ``group_by`` fields defining the group,
+    which are set to the values of the group.
+    """
+
+    def __init__(self, group_by, key, values, level):
+        super(SubtotalRecord, self).__init__(values)
+        self.update(zip(group_by, key))
+        self.level = level
+
+
+def _group_events(records, group_by):
+    """ Walk ``records``, sorted by ``group_by``, yielding
+    ``(None, key, record)`` for each record and ``(level, key, None)``
+    each time a group ends, innermost groups first.
+    """
+    depth = len(group_by)
+    last = None
+    for record in records:
+        key = tuple(record.get(field_name) for field_name in group_by)
+        if last is not None:
+            changed = depth
+            for idx in range(depth):
+                if key[idx] != last[idx]:
+                    changed = idx
+                    break
+            for level in range(depth, changed, -1):
+                yield level, last[:level], None
+        last = key
+        yield None, key, record
+    if last is not None:
+        for level in range(depth, 0, -1):
+            yield level, last[:level], None
+
+
+def group_records(records, group_by, subtotals, on_totals=None):
+    """ Yield ``records``, sorted by ``group_by``, each group followed by a
+    ``SubtotalRecord``; subtotals and grand totals, passed to
+    ``on_totals``, are all computed in the same pass.
+    """
+
+    def make_reducers():
+        return dict(
+            (field_name, make_reducer(func))
+            for field_name, func in subtotals.items()
+            if func
+        )
+
+    levels = dict((level, make_reducers()) for level in range(1, len(group_by) + 1))
+    totals = make_reducers()
+    for level, key, record in _group_events(records, group_by):
+        if record is None:
+            values = dict(
+                (field_name, reducer.result())
+                for field_name, reducer in levels[level].items()
+            )
+            levels[level] = make_reducers()
+            yield SubtotalRecord(group_by, key, values, level)
+            continue
+        for reducers in list(levels.values()) + [totals]:
+            for field_name, reducer in reducers.items():
+                reducer.add(record[field_name])
+        yield record
+    if on_totals is not None:
+        on_totals(
+            dict(
+                (field_name, reducer.result())
+                for field_name, reducer in totals.items()
+            )
+        )
+
+
+def insert_subtotals(records, group_by, subtotals):
+    """ Yield ``records``, sorted by ``group_by``, each group followed by a
+    ``SubtotalRecord`` with the values found in ``subtotals`` for the key
+    of the group.
+    """
+    for level, key, record in _group_events(records, group_by):
+        if record is None:
+            yield SubtotalRecord(group_by, key, subtotals.get(key, {}), level)
+        else:
+            yield record
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import logging
 from collections import OrderedDict
 
+import six
+
 from django import forms
 from django.apps import apps
 from django.conf import settings
@@ -11,9 +15,14 @@ from django.core.paginator import InvalidPage
 from django.core.exceptions import PermissionDenied, ImproperlyConfigured
 from django.views.generic.edit import FormMixin
 from django.views.generic import TemplateView
-from django.http import HttpResponse
-from django.utils.html import format_html
+from django.http import StreamingHttpResponse
+from django.utils.formats import localize
+from django.utils.html import conditional_escape, format_html
+from django.utils.safestring import mark_safe
+from django.utils.timezone import template_localtime
+from django.utils.translation import get_language
 from django.shortcuts import render
+from django.utils.module_loading import import_string
 
 try:
     # Django 2
@@ -23,6 +32,11 @@ except ModuleNotFoundError:
     from django.templatetags.static import static
 from django.contrib.admin.options import IncorrectLookupParameters
 
+from .cache import ParamsEncoder, make_key
+from .compression import gzip_stream, zip_stream
+from .db import ReportAborted
+from .results import IterPaginator
+
 logger = logging.getLogger(__name__)
 
 ALL_VAR = "all"
@@ -32,15 +46,33 @@ EXPORT_VAR = "e"
 CONTROL_VARS = [ALL_VAR, ORDER_VAR, PAGE_VAR, EXPORT_VAR]
 
 
+class ResultRow(list):
+    """ The ``(alignment, value)`` couples of a row; ``subtotal`` is the
+    group level of subtotal rows, 0 for plain records.
+    """
+
+    subtotal = 0
+
+
+def _render_value(value):
+    """ Render ``value`` as the ``{{ value }}`` template tag would.
+    """
+    value = localize(template_localtime(value))
+    if not isinstance(value, six.text_type):
+        value = six.text_type(value)
+    return conditional_escape(value)
+
+
 class ReportList(object):
     def __init__(self, request, report):
         self.request = request
         self.report = report
         self.ordering_field_columns = self._get_ordering_field_columns()
         self.report.set_sort_params(*self._get_ordering())
-        self.multi_page = False
-        self.can_show_all = True
-        self.paginator = None  # self.report.get_paginator()
+        self._paginator = None
+        self._multi_page = False
+        self._can_show_all = True
+        self._records = None
         try:
             self.page_num = int(self.request.GET.get(PAGE_VAR, 0))
         except ValueError:
@@ -114,6 +146,13 @@ class ReportList(object):
 
     def headers(self):
         fields = self.report.get_fields()
+        # Copy the query once, only the ordering changes between urls
+        params = self.request.GET.copy()
+
+        def order_url(o_list):
+            params[ORDER_VAR] = ".".join(o_list)
+            return "?%s" % params.urlencode()
+
         for i, field in enumerate(fields):
             name = field[0]
             label = field[1]
@@ -162,15 +201,9 @@ class ReportList(object):
                 "sorted": sorted_,
                 "ascending": order_type == "asc",
                 "sort_priority": sort_priority,
-                "url_primary": self.get_query_string(
-                    {ORDER_VAR: ".".join(o_list_primary)}
-                ),
-                "url_remove": self.get_query_string(
-                    {ORDER_VAR: ".".join(o_list_remove)}
-                ),
-                "url_toggle": self.get_query_string(
-                    {ORDER_VAR: ".".join(o_list_toggle)}
-                ),
+                "url_primary": order_url(o_list_primary),
+                "url_remove": order_url(o_list_remove),
+                "url_toggle": order_url(o_list_toggle),
                 "class_attrib": format_html(' class="{0}"', " ".join(th_classes))
                 if th_classes
                 else "",
@@ -178,6 +211,8 @@ class ReportList(object):
 
     @property
     def totals(self):
+        # Lazy results must be paginated before the totals go through them
+        self.paginate()
         fields = self.report.get_fields()
         for idx, value in enumerate(self.report.iter_totals()):
             yield (self.report.get_alignment(fields[idx][0]), value)
@@ -185,27 +220,130 @@ class ReportList(object):
     @property
     def results(self):
         fields = self.report.get_fields()
-        for record in self.paginate():
-            yield [
+        records = self.paginate()
+        for record, values in zip(records, self.report.iter_results(records)):
+            row = ResultRow(
                 (self.report.get_alignment(fields[idx][0]), value)
-                for idx, value in enumerate(record)
-            ]
+                for idx, value in enumerate(values)
+            )
+            row.subtotal = getattr(record, "level", 0)
+            yield row
+
+    def render_rows(self):
+        """ Render the ``<tr>`` elements of the current page, without going
+        through the template engine for every cell.
+        """
+        html = []
+        parity = 0
+        for row in self.results:
+            if row.subtotal:
+                html.append('<tr class="subtotal subtotal-%d">' % row.subtotal)
+            else:
+                html.append('<tr class="row%d">' % (parity + 1))
+                parity ^= 1
+            for alignment, value in row:
+                html.append(
+                    '<td class="%s">%s</td>'
+                    % (conditional_escape(alignment), _render_value(value))
+                )
+            html.append("</tr>")
+        return mark_safe("".join(html))
+
+    @property
+    def cache_timeout(self):
+        return self.report.get_cache_timeout()
+
+    @property
+    def table_cache_key(self):
+        """ Identify the rendered table of the current page in the report
+        cache; ``None`` if the report is not cached.
+        """
+        if self.cache_timeout is None:
+            return None
+        # The key is known before paginating: on a hit the page is neither
+        # fetched nor formatted
+        query = hashlib.md5(self.request.GET.urlencode().encode("utf-8")).hexdigest()
+        return make_key(self.report, "table:%s:%s" % (get_language(), query))
 
     def get_result_count(self):
-        return len(self.report)
+        paginator = self.paginator
+        if self.report.get_group_by():
+            # Subtotal rows are not results
+            count, final = self.report.get_record_count()
+            return count if final else "%d+" % count
+        if (
+            isinstance(paginator, IterPaginator)
+            and not paginator.object_list.exhausted
+        ):
+            return "%d+" % paginator.count
+        return paginator.count
+
+    @property
+    def paginator(self):
+        return self._get_paginator()
+
+    def _get_paginator(self):
+        """ Return the paginator of the report; the records of the page are
+        only fetched by ``paginate``, so that the pagination links and the
+        count can be rendered around a cached table.
+        """
+        if self._paginator is None:
+            self.report.check_max_rows()
+            paginator = self.report.get_paginator()
+            self._paginator = paginator
+            self._set_page_flags()
+            if isinstance(paginator, IterPaginator):
+                # Iterators must be pulled up to the page to be counted
+                self.paginate()
+        return self._paginator
+
+    @property
+    def multi_page(self):
+        self._get_paginator()
+        return self._multi_page
+
+    @property
+    def can_show_all(self):
+        self._get_paginator()
+        return self._can_show_all
+
+    def _set_page_flags(self):
+        result_count = self._paginator.count
+        self._multi_page = result_count > self.report.get_list_per_page()
+        self._can_show_all = result_count <= self.report.get_list_max_show_all()
 
     def paginate(self):
-        records = self.report.results
-        self.paginator = self.report.get_paginator()
-        result_count = self.paginator.count
-        self.multi_page = result_count > self.report.get_list_per_page()
-        self.can_show_all = result_count <= self.report.get_list_max_show_all()
-        if not (self.show_all and self.can_show_all) and self.multi_page:
+        if self._records is not None:
+            return self._records
+        paginator = self._get_paginator()
+        if isinstance(paginator, IterPaginator):
+            # Pull lazy results just as far as the requested page, plus
+            # one record to know whether there is a next one.
+            if self.show_all:
+                paginator.prefetch(self.report.get_list_max_show_all() + 1)
+            else:
+                paginator.prefetch(
+                    (self.page_num + 1) * self.report.get_list_per_page() + 1
+                )
+            self._set_page_flags()
+        records = paginator.object_list
+        if not (self.show_all and self._can_show_all) and self._multi_page:
             try:
-                records = self.paginator.page(self.page_num + 1).object_list
+                records = paginator.page(self.page_num + 1).object_list
             except InvalidPage:
                 raise IncorrectLookupParameters
-        return records
+        # At most a page, or list_max_show_all records
+        self._records = list(records)
+        if (
+            isinstance(paginator, IterPaginator)
+            and self.report.get_has_totals()
+            and not paginator.object_list.exhausted
+        ):
+            # The totals go through the remaining records anyway: compute
+            # them now, so that the count shown above the table is exact
+            self.report.get_totals()
+            self._set_page_flags()
+        return self._records
 
 
 class Opts(object):
@@ -262,22 +400,25 @@ class ReportView(TemplateView, FormMixin):
             form = self.get_export_form()
         ctx = {
             "form": form,
-            "back": "?%s"
-            % "&".join(
-                [
-                    "%s=%s" % param
-                    for param in self.request.GET.items()
-                    if param[0] != EXPORT_VAR
-                ]
-            ),
+            "back": self._back_url(),
         }
         return render(self.request, "admin/export.html", ctx)
 
+    def _back_url(self):
+        """ The url of the report with the current filters and sorting.
+        """
+        params = self.request.GET.copy()
+        params.pop(EXPORT_VAR, None)
+        return "?%s" % params.urlencode()
+
     def get_report_class(self):
         if self.report_class is None:
             raise ImproperlyConfigured(
                 "You must specify `report_class` or override `get_report_class`"
             )
+        if isinstance(self.report_class, six.string_types):
+            # Registered by dotted path, imported on the first request
+            self.report_class = import_string(self.report_class)
         return self.report_class
 
     def get_report_args(self):
@@ -297,11 +438,16 @@ class ReportView(TemplateView, FormMixin):
             raise PermissionDenied()
         form = self.get_export_form(data=self.request.POST)
         if form.is_valid():
-            context = self.get_context_data(**kwargs)
-            filename = context["title"].lower().replace(" ", "_")
-            response = HttpResponse(content_type="text/csv")
-            response["Content-Disposition"] = 'attachment;filename="%s.csv"' % filename
-            self.report.to_csv(response, **form.cleaned_data)
+            content = self._export_stream(form, **kwargs)
+            try:
+                # The report is evaluated and the first rows are produced
+                # before the response starts: a timeout or a limit there
+                # can still be reported to the user.
+                filename, content_type = next(content)
+            except ReportAborted as e:
+                return self._abort(e)
+            response = StreamingHttpResponse(content, content_type=content_type)
+            response["Content-Disposition"] = 'attachment;filename="%s"' % filename
             return response
         return self._export(form=form)
 
@@ -311,7 +457,67 @@ class ReportView(TemplateView, FormMixin):
             raise PermissionDenied()
         if EXPORT_VAR in request.GET:
             return self._export()
-        return super(ReportView, self).get(request, *args, **kwargs)
+        try:
+            with self.report.trace_memory(), self.report.guard():
+                response = super(ReportView, self).get(request, *args, **kwargs)
+                response.render()
+        except ReportAborted as e:
+            return self._abort(e)
+        return response
+
+    def _export_stream(self, form, **kwargs):
+        """ Yield the file name and the content type of the export, once the
+        report is evaluated and the first chunk is ready, then the chunks.
+
+        Every step is kept within the query budget and limits of the
+        report; memory is measured from the evaluation until the stream
+        ends or the response closes it.
+        """
+        with self.report.trace_memory():
+            with self.report.guard():
+                context = self.get_context_data(**kwargs)
+                self.report.check_max_rows()
+            filename = context["title"].lower().replace(" ", "_")
+            options = dict(form.cleaned_data)
+            compression = options.pop("compression", "")
+            rows = self.report.iter_csv(**options)
+            if compression == "gzip":
+                chunks = gzip_stream(rows)
+                content_type = "application/gzip"
+                filename = "%s.csv.gz" % filename
+            elif compression == "zip":
+                metadata = json.dumps(
+                    self.report.get_export_metadata(**options),
+                    cls=ParamsEncoder,
+                    indent=2,
+                )
+                chunks = zip_stream(
+                    [("%s.csv" % filename, rows), ("%s.json" % filename, [metadata])]
+                )
+                content_type = "application/zip"
+                filename = "%s.zip" % filename
+            else:
+                chunks = rows
+                content_type = "text/csv"
+                filename = "%s.csv" % filename
+            chunks = iter(chunks)
+            missing = object()
+            with self.report.guard():
+                chunk = next(chunks, missing)
+            yield filename, content_type
+            while chunk is not missing:
+                yield chunk
+                with self.report.guard():
+                    chunk = next(chunks, missing)
+
+    def _abort(self, error):
+        logger.warning("Report %s aborted: %s", self.report.__class__.__name__, error)
+        ctx = {
+            "title": self.report.get_title(),
+            "message": "%s" % error,
+            "back": self._back_url(),
+        }
+        return render(self.request, "admin/report_error.html", ctx)
 
     def get_form_kwargs(self):
         kwargs = super(ReportView, self).get_form_kwargs()
@@ -333,7 +539,7 @@ class ReportView(TemplateView, FormMixin):
         return super(ReportView, self).get_form(form_class)
 
     def get_form_class(self):
-        return self.report_class.form_class
+        return self.get_report_class().form_class
 
     def get_context_data(self, **kwargs):
         kwargs = super(ReportView, self).get_context_data(**kwargs)